@@ -1,6 +1,8 @@
 import gdown 
-import random, time, requests, os, json, base64
+import random, time, requests, os, json, base64, warnings
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import pandas as pd
 import numpy as np
@@ -8,12 +10,56 @@ from matplotlib import pyplot as plt
 from matplotlib.patches import Circle
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 from astropy.visualization import ZScaleInterval
+from PIL import Image as PILImage
 
 from vertexai.generative_models import GenerativeModel, Part, FinishReason, Image
 import vertexai.preview.generative_models as generative_models
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
+from google.api_core.exceptions import GoogleAPIError
+import google.auth
+import google.auth.transport.requests
 import google.cloud.aiplatform as aiplatform
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types as bqs_types
+import pyarrow as pa
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  from numba import njit, prange
+except ImportError:
+  njit = None
+
+# Shared HTTP session so repeated API calls reuse pooled TCP/TLS connections.
+# Only failed connections are retried: creating a batch prediction job is not
+# idempotent, so POST requests are deliberately not retried on error responses.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50,
+                                       max_retries=Retry(total=3, backoff_factor=0.3)))
+
+# Application default credentials, loaded on first use and refreshed when expired
+_CREDS = None
+
+def _access_token():
+  """Returns a valid OAuth access token, refreshing the cached credentials only when needed."""
+  global _CREDS
+  if _CREDS is None:
+    _CREDS, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+  if not _CREDS.valid:
+    _CREDS.refresh(google.auth.transport.requests.Request(_SESSION))
+  return _CREDS.token
+
+# Boolean ring mask for the red circle marking the candidate at the image centre.
+# Radius 7 with a thin line between radius 6 and 7, precomputed once on a (15, 15) grid.
+_RING_RADIUS = 7
+_yy, _xx = np.mgrid[-_RING_RADIUS:_RING_RADIUS + 1, -_RING_RADIUS:_RING_RADIUS + 1]
+RING = ((_xx**2 + _yy**2 >= (_RING_RADIUS - 1)**2) & (_xx**2 + _yy**2 <= _RING_RADIUS**2))
 
 def generate(model, prompt):
   """Generates text based on the provided prompt using a Gemini model.
@@ -37,6 +83,14 @@ def generate(model, prompt):
   # Return the generated responses.
   return responses
 
+# Labels for the new, reference and difference images in the dynamic prompt
+_LABELS = ("new image: ", "reference image: ", "difference image: ")
+
+@lru_cache(maxsize=512)
+def _load_part(path):
+  """Loads an image file as a Gemini Part, cached so each file is read and encoded once per session."""
+  return Part.from_image(Image.load_from_file(path))
+
 def create_ex(data_index, examples):
   """
     Loads and returns a list containing strings and images to be used for Gemini for a given data index.
@@ -53,23 +107,142 @@ def create_ex(data_index, examples):
             - Image object loaded from "data/pics/Example_{data_index}_fig_1.png"
             - "difference image: "
             - Image object loaded from "data/pics/Example_{data_index}_fig_2.png"
+
+    The images are cached per path, the cache is cleared whenever save_picture or
+    save_pictures_batch write new pictures so regenerated files are always reloaded.
     """   
-  str_new = "new image: " # String for labeling the new image
-  str_ref = "reference image: " # String for labeling the reference image
-  str_dif = "difference image: " # String for labeling the difference image
-  if examples:
-    # Load images from files using the given data index
-    image1 = Part.from_image(Image.load_from_file(f"data/pics/prompt_pics/Example_{data_index}_fig_0.png"))
-    image2 = Part.from_image(Image.load_from_file(f"data/pics/prompt_pics/Example_{data_index}_fig_1.png"))
-    image3 = Part.from_image(Image.load_from_file(f"data/pics/prompt_pics/Example_{data_index}_fig_2.png"))
-  else:
-    # Load images from files using the given data index
-    image1 = Part.from_image(Image.load_from_file(f"data/pics/Example_{data_index}_fig_0.png"))
-    image2 = Part.from_image(Image.load_from_file(f"data/pics/Example_{data_index}_fig_1.png"))
-    image3 = Part.from_image(Image.load_from_file(f"data/pics/Example_{data_index}_fig_2.png"))
-    
+  prefix = "data/pics/prompt_pics/Example_" if examples else "data/pics/Example_"
+  # Load images from files using the given data index
+  parts = [_load_part(f"{prefix}{data_index}_fig_{j}.png") for j in range(3)]
   # Return the list containing strings and images
-  return [str_new, image1, str_ref, image2, str_dif, image3]
+  return [_LABELS[0], parts[0], _LABELS[1], parts[1], _LABELS[2], parts[2]]
+
+_ZSCALE = ZScaleInterval(contrast=0.1)
+
+def zscale_limits(triplet, zscale=_ZSCALE):
+  """Computes the ZScaleInterval limits of every channel of an image stack at once.
+
+  This is a vectorized port of astropy's ZScaleInterval.get_limits: the samples of all
+  channels are taken in one strided slice and the iterative k-sigma clipped line fits
+  are solved together in closed form, giving the same limits as calling get_limits
+  on each channel. Channels with non-finite values fall back to get_limits.
+
+  Args:
+    triplet: An array of shape (H, W, C), e.g. the (new, reference, difference) images of one index.
+    zscale: The ZScaleInterval whose parameters are used.
+
+  Returns:
+    A tuple (vmin, vmax) of float arrays of length C.
+  """
+  flat = triplet.reshape(-1, triplet.shape[-1])
+  if not np.isfinite(flat).all():
+    limits = np.array([zscale.get_limits(triplet[..., c]) for c in range(triplet.shape[-1])], dtype=np.float64)
+    return limits[:, 0], limits[:, 1]
+
+  # Sample the images with the same stride as astropy and sort every channel
+  stride = int(max(1.0, flat.shape[0] / zscale.n_samples))
+  samples = np.sort(flat[::stride][:zscale.n_samples].T.astype(np.float64), axis=1)
+  nch, npix = samples.shape
+  vmin = samples[:, 0].copy()
+  vmax = samples[:, -1].copy()
+
+  minpix = max(zscale.min_npixels, int(npix * zscale.max_reject))
+  x = np.arange(npix, dtype=np.float64)
+  ngoodpix = np.full(nch, npix)
+  last_ngoodpix = np.full(nch, npix + 1)
+  badpix = np.zeros((nch, npix), dtype=bool)
+  slope = np.zeros(nch)
+  # Window of the bad pixel dilation, matching np.convolve(..., mode="same")
+  ngrow = max(1, int(npix * 0.01))
+  pad = ((0, 0), (ngrow // 2 + 1, (ngrow - 1) // 2))
+
+  active = np.ones(nch, dtype=bool)
+  for _ in range(zscale.max_iterations):
+    active &= (ngoodpix < last_ngoodpix) & (ngoodpix >= minpix)
+    if not active.any():
+      break
+
+    # Least squares line through the good pixels of every channel
+    good = ~badpix
+    n = good.sum(axis=1)
+    sx, sy = (good * x).sum(axis=1), (good * samples).sum(axis=1)
+    sxx, sxy = (good * x * x).sum(axis=1), (good * x * samples).sum(axis=1)
+    fit_slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    fit_intercept = (sy - fit_slope * sx) / n
+    flat_res = samples - (fit_intercept[:, None] + fit_slope[:, None] * x)
+
+    # k-sigma rejection around the fitted line, using the std of the good pixels
+    mean = (good * flat_res).sum(axis=1) / n
+    std = np.sqrt((good * (flat_res - mean[:, None])**2).sum(axis=1) / n)
+    threshold = (zscale.krej * std)[:, None]
+    new_badpix = badpix | (flat_res < -threshold) | (flat_res > threshold)
+
+    # Dilate the mask with a window of length ngrow
+    csum = np.cumsum(np.pad(new_badpix, pad).astype(np.int64), axis=1)
+    new_badpix = (csum[:, ngrow:] - csum[:, :-ngrow]) > 0
+
+    badpix[active] = new_badpix[active]
+    slope[active] = fit_slope[active]
+    last_ngoodpix = np.where(active, ngoodpix, last_ngoodpix)
+    ngoodpix = np.where(active, (~badpix).sum(axis=1), ngoodpix)
+
+  ok = ngoodpix >= minpix
+  if zscale.contrast > 0:
+    slope = slope / zscale.contrast
+  center_pixel = (npix - 1) // 2
+  median = np.median(samples, axis=1)
+  vmin = np.where(ok, np.maximum(vmin, median - (center_pixel - 1) * slope), vmin)
+  vmax = np.where(ok, np.minimum(vmax, median + (npix - center_pixel) * slope), vmax)
+  return vmin, vmax
+
+if njit is not None:
+  @njit(parallel=True, fastmath=True, cache=True)
+  def _scale_kernel(img, vmin, span, scale, out):
+    """Shifts, clips, rescales and quantizes an image to uint8 in a single fused float32 pass."""
+    for i in prange(img.shape[0]):
+      for j in range(img.shape[1]):
+        v = np.float32(img[i, j]) - vmin
+        if v < np.float32(0.0):
+          v = np.float32(0.0)
+        if v > span:
+          v = span
+        out[i, j] = np.uint8(v * scale)
+else:
+  _scale_kernel = None
+
+def scale_image(image, out=None, buf=None, limits=None):
+  """Scales an image to the 0-255 range with ZScaleInterval limits and quantizes it to uint8.
+
+  Args:
+    image: A 2D array with the raw image data.
+    out: An optional (H, W) uint8 array receiving the result.
+    buf: An optional (H, W) float32 scratch array used for the NumPy fallback.
+    limits: Optional precomputed (vmin, vmax), e.g. from zscale_limits.
+
+  Returns:
+    The (H, W) uint8 scaled image.
+  """
+  if out is None:
+    out = np.empty(image.shape, dtype=np.uint8)
+  vmin, vmax = _ZSCALE.get_limits(image) if limits is None else limits
+  # Both paths below work in float32 with the same constants, so they give identical output
+  vmin, vmax = np.float32(vmin), np.float32(vmax)
+  span = vmax - vmin
+  scale = np.float32(255.0) / span
+  # Single fused pass when numba is installed and supports the input dtype,
+  # other inputs (e.g. big-endian FITS cutouts or float16) use the NumPy path
+  dt = image.dtype
+  if _scale_kernel is not None and dt.isnative and (dt.kind in "iu" or (dt.kind == "f" and dt.itemsize >= 4)):
+    _scale_kernel(image, vmin, span, scale, out)
+    return out
+  if buf is None:
+    buf = np.empty(image.shape, dtype=np.float32)
+  # Fused clip and rescale in float32: shift, clip to the window, then multiply in place
+  np.subtract(image, vmin, out=buf, dtype=np.float32)
+  np.clip(buf, np.float32(0), span, out=buf)
+  np.multiply(buf, scale, out=buf)
+  np.copyto(out, buf, casting='unsafe')
+  return out
 
 def preprocess(nd_array, index_no):
   """Preprocesses a triplet of images from a multi-dimensional array for analysis using ZScaleInterval from astropy.
@@ -79,43 +252,83 @@ def preprocess(nd_array, index_no):
     index_no: The index of the image triplet to be processed.
 
   Returns:
-    A tuple containing:
-      - real_image: A 2D array representing the new image.
-      - ref_image: A 2D array representing the reference image.
-      - diff_image: A 2D array representing the difference between the reference and real images.
+    A uint8 array of shape (3, H, W) scaled to the 0-255 range, containing:
+      - [0]: the new image.
+      - [1]: the reference image.
+      - [2]: the difference between the reference and real images.
   """
-  zscale = ZScaleInterval(contrast=0.1)
+  # Preallocate the output and the float scratch once, the scaling below writes into them in place
+  scaled = np.empty((3,) + nd_array.shape[1:3], dtype=np.uint8)
+  buf = np.empty(nd_array.shape[1:3], dtype=np.float32)
+  vmin, vmax = zscale_limits(nd_array[index_no])
 
-  def scale_image(image):
-      vmin, vmax = zscale.get_limits(image)
-      image = np.clip(image, vmin, vmax)
-      image = 255 * (image - vmin) / (vmax - vmin)
-      return image
+  # Scale the real, reference and difference images
+  for c in range(3):
+    scale_image(nd_array[index_no, :, :, c], scaled[c], buf, (vmin[c], vmax[c]))
 
-  # Get and scale the real image
-  real_image = scale_image(nd_array[index_no, :, :, 0])
+  # Return the real image, the reference image, the difference image
+  return scaled
 
-  # Get and scale the reference image
-  ref_image = scale_image(nd_array[index_no, :, :, 1])
+def _iter_scaled(nd_array, index_no):
+  """Yields the scaled real, reference and difference images of a triplet one at a time.
 
-  # Get and scale the difference image
-  diff_image = scale_image(nd_array[index_no, :, :, 2])
+  The same (H, W) buffers are reused for the three channels, so each yielded array
+  must be consumed (e.g. converted by add_red_circle_fast) before the next one is requested.
+  """
+  out = np.empty(nd_array.shape[1:3], dtype=np.uint8)
+  buf = np.empty(nd_array.shape[1:3], dtype=np.float32)
+  vmin, vmax = zscale_limits(nd_array[index_no])
+  for c in range(3):
+    yield scale_image(nd_array[index_no, :, :, c], out, buf, (vmin[c], vmax[c]))
 
-  # Return the real image, the reference image, the difference image
-  return [real_image, ref_image, diff_image]
+def _write_png(path, rgb):
+  """Writes an RGB uint8 array as png with Pillow, skipping matplotlib's colormapping.
+
+  A low compression level trades slightly larger files for a much faster encode.
+  """
+  PILImage.fromarray(rgb).save(path, format="PNG", compress_level=1)
+
+# Shared pool for png writes, reused across calls so save_picture loops do not pay for pool setup
+_WRITE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def _write_pngs(tasks):
+  """Writes (path, array) pairs as png files in parallel threads, png compression releases the GIL."""
+  list(_WRITE_POOL.map(lambda task: _write_png(*task), tasks))
+  # The pictures on disk changed, drop the cached Parts so create_ex reloads them
+  _load_part.cache_clear()
 
 def save_picture(dataset, index_no, example):
   # Save the images as png
-  processed_im = preprocess(dataset, index_no)
-  if example: 
-    for j in range(3):
-      img_with_circle = add_red_circle(processed_im[j])
-      plt.imsave(f"data/pics/prompt_pics/Example_{index_no}_fig_{j}.png", img_with_circle)
+  folder = "data/pics/prompt_pics" if example else "data/pics"
+  _write_pngs([(f"{folder}/Example_{index_no}_fig_{j}.png", add_red_circle_fast(scaled))
+               for j, scaled in enumerate(_iter_scaled(dataset, index_no))])
 
-  else:
-    for j in range(3):
-      img_with_circle = add_red_circle(processed_im[j])
-      plt.imsave(f"data/pics/Example_{index_no}_fig_{j}.png", img_with_circle)
+def save_pictures_batch(dataset, indices, example, q_low=1.0, q_high=99.0):
+  """Saves the triplets for several indices at once as png files.
+
+  Instead of running ZScaleInterval per image, the display limits of all the
+  selected images are approximated with percentiles computed in a single
+  vectorized pass, then every image is clipped and scaled at once.
+
+  Args:
+    dataset: A multi-dimensional array of shape (N, H, W, 3) containing the image triplets.
+    indices: The indices of the triplets to be saved.
+    example: A flag that saves the pictures as prompt examples in "data/pics/prompt_pics/".
+    q_low: The lower percentile used as the display minimum.
+    q_high: The upper percentile used as the display maximum.
+  """
+  indices = np.asarray(indices)
+  n, h, w = len(indices), dataset.shape[1], dataset.shape[2]
+  imgs = dataset[indices].transpose(0, 3, 1, 2).reshape(-1, h * w).astype(np.float32)
+
+  # Per image display limits and scaling, broadcast over the rows
+  vmin, vmax = np.percentile(imgs, [q_low, q_high], axis=1)
+  span = (vmax - vmin)[:, None]
+  out = ((imgs - vmin[:, None]).clip(0, span) * (255.0 / span)).reshape(n, 3, h, w).astype(np.uint8)
+
+  folder = "data/pics/prompt_pics" if example else "data/pics"
+  _write_pngs([(f"{folder}/Example_{index_no}_fig_{j}.png", add_red_circle_fast(out[k, j]))
+               for k, index_no in enumerate(indices) for j in range(3)])
 
 def save_prompt(instructions, run_name):
   """Saves the system instructions to a text file. It first strips the images from the system prompt and only saves the text part of the prompt to save space.
@@ -141,28 +354,24 @@ def build_experiment_vars(**kwargs):
   """
   return kwargs
 
-def create_batch_prediction_job(project_id, request_json_path):
+def create_batch_prediction_job(project_id, request_data):
   """
   Sends a POST request to the Google Cloud AI Platform Batch Prediction API.
 
   Args:
     project_id: The Google Cloud Project ID.
-    request_json_path: The path to the JSON file containing the batch prediction request.
+    request_data: The batch prediction request as a dictionary, see build_request.
 
   Returns:
     The response from the API call.
   """
 
-  # Get the access token from gcloud
-  access_token = os.popen('gcloud auth print-access-token').read().strip()
+  # Get the cached access token
+  access_token = _access_token()
 
   # Construct the API endpoint URL
   url = f"https://us-central1-aiplatform.googleapis.com/v1/projects/{project_id}/locations/us-central1/batchPredictionJobs"
 
-  # Read the request JSON file
-  with open(request_json_path, 'r') as f:
-    request_data = json.load(f)
-
   # Set the headers
   headers = {
     "Authorization": f"Bearer {access_token}",
@@ -170,39 +379,41 @@ def create_batch_prediction_job(project_id, request_json_path):
   }
 
   # Send the POST request
-  response = requests.post(url, headers=headers, json=request_data)
+  response = _SESSION.post(url, headers=headers, json=request_data)
 
   return response.json()
 
-def write_request(name, model, inputUri, outputUri):
-  """Writes a JSON file containing a batch prediction request to Google Cloud AI Platform.
+def build_request(name, model, inputUri, outputUri):
+  """Builds a batch prediction request to Google Cloud AI Platform.
 
-  This function creates a JSON file named "request.json" with the specified parameters for a batch prediction job.
-  The JSON file follows the schema required by the Google Cloud AI Platform Batch Prediction API.
+  The request follows the schema required by the Google Cloud AI Platform Batch Prediction API
+  and can be passed directly to create_batch_prediction_job.
 
   Args:
     name: The name of the batch prediction job.
     model: The name of the model to use for batch prediction.
     inputUri: The BigQuery URI of the input data for batch prediction.
     outputUri: The BigQuery URI of the output data for batch prediction.
+
+  Returns:
+    A dictionary with the batch prediction request.
   """
-  with open("request.json", 'w') as f:
-    json.dump({
-        "displayName": name,
-        "model": "publishers/google/models/" + model,
-        "inputConfig": {
-          "instancesFormat":"bigquery",
-          "bigquerySource":{
-            "inputUri" : inputUri
-          }
-        },
-        "outputConfig": {
-          "predictionsFormat":"bigquery",
-          "bigqueryDestination":{
-            "outputUri": outputUri
-          }
+  return {
+      "displayName": name,
+      "model": "publishers/google/models/" + model,
+      "inputConfig": {
+        "instancesFormat":"bigquery",
+        "bigquerySource":{
+          "inputUri" : inputUri
+        }
+      },
+      "outputConfig": {
+        "predictionsFormat":"bigquery",
+        "bigqueryDestination":{
+          "outputUri": outputUri
         }
-    }, f, indent=4)
+      }
+  }
 
 def if_tbl_exists(bq_client, table_ref):
     """Checks if a table exists in BigQuery and creates it if it doesn't.
@@ -212,7 +423,7 @@ def if_tbl_exists(bq_client, table_ref):
       table_ref: A BigQuery table reference object.
 
   Returns:
-      True if the table exists, False otherwise.
+      True if the table exists, otherwise the newly created Table object.
   """
     try:
         bq_client.get_table(table_ref)
@@ -220,7 +431,31 @@ def if_tbl_exists(bq_client, table_ref):
     except NotFound:
         return bq_client.create_table(table_ref)
 
-def batch_data_create(stat_prompt, dyna_prompt, TEMPERATURE, TOP_P):
+# Safety settings shared by every batch request
+_SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_NONE"
+    }
+]
+
+def prompt_parts(prompt):
+  """Converts a list of strings and Parts into the request dictionaries of the batch payload."""
+  return [{"text": p} if isinstance(p, str) else p.to_dict() for p in prompt]
+
+def batch_data_create(stat_prompt, dyna_prompt, TEMPERATURE, TOP_P, prefix_parts=None):
   """
   Creates a JSON payload for batch data generation with OpenAI API.
 
@@ -231,19 +466,17 @@ def batch_data_create(stat_prompt, dyna_prompt, TEMPERATURE, TOP_P):
     TEMPERATURE: Temperature parameter for text generation.
     TOP_P: Top P parameter for text generation.
     TOP_K: Top K parameter for text generation.
+    prefix_parts: Optional already converted parts (see prompt_parts) placed before dyna_prompt,
+                  so a prefix shared by the whole batch is only converted once.
 
   Returns:
     A JSON string representing the batch data request payload.
   """
-  dyna_prompt_part = []
-  for i in range(len(dyna_prompt)):
-    if type(dyna_prompt[i]) == str:
-      dyna_prompt_part.append({"text": dyna_prompt[i]})
-    else:
-      dyna_prompt_part.append(dyna_prompt[i].to_dict())
-  
-  return  json.dumps(
-    {
+  dyna_prompt_part = prompt_parts(dyna_prompt)
+  if prefix_parts is not None:
+    dyna_prompt_part = prefix_parts + dyna_prompt_part
+
+  payload = {
     "contents": [
       {
         "role": "user",
@@ -263,28 +496,98 @@ def batch_data_create(stat_prompt, dyna_prompt, TEMPERATURE, TOP_P):
         "topP": TOP_P,
         "responseMimeType": "application/json",
     },
-    "safetySettings": [
-        {
-            "category": "HARM_CATEGORY_HATE_SPEECH",
-            "threshold": "BLOCK_NONE"
-        },
-        {
-            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-            "threshold": "BLOCK_NONE"
-        },
-        {
-            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-            "threshold": "BLOCK_NONE"
-        },
-        {
-            "category": "HARM_CATEGORY_HARASSMENT",
-            "threshold": "BLOCK_NONE"
-        }
-    ],
-  })
+    "safetySettings": _SAFETY_SETTINGS,
+  }
+  # Compact encoding, orjson when available (falling back to json for types orjson rejects)
+  if orjson is not None:
+    try:
+      return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    except TypeError:
+      pass
+  return json.dumps(payload, separators=(',', ':'))
 
   from google.cloud import bigquery
 
+# Job states after which a batch prediction job no longer changes
+_JOB_TERMINAL_STATES = {
+    aiplatform.gapic.JobState.JOB_STATE_SUCCEEDED,
+    aiplatform.gapic.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    aiplatform.gapic.JobState.JOB_STATE_FAILED,
+    aiplatform.gapic.JobState.JOB_STATE_CANCELLED,
+    aiplatform.gapic.JobState.JOB_STATE_EXPIRED,
+}
+
+def wait_for_job(job, initial_delay=2.0, max_delay=60.0):
+  """Waits for a Vertex AI job to finish, polling with exponential backoff and jitter.
+
+  Args:
+    job: An aiplatform job object, e.g. a BatchPredictionJob.
+    initial_delay: The first wait between polls in seconds.
+    max_delay: The upper bound of the wait between polls in seconds.
+
+  Raises:
+    RuntimeError: If the job ends in a state other than succeeded.
+  """
+  delay = initial_delay
+  # job.state refreshes the job resource on every access
+  while (state := job.state) not in _JOB_TERMINAL_STATES:
+    time.sleep(delay + random.random())
+    delay = min(delay * 1.5, max_delay)
+  if state not in (aiplatform.gapic.JobState.JOB_STATE_SUCCEEDED,
+                   aiplatform.gapic.JobState.JOB_STATE_PARTIALLY_SUCCEEDED):
+    raise RuntimeError(f"Job {job.resource_name} ended with state {state.name}: {job._gca_resource.error}")
+
+# Batches up to this many rows are streamed with the Storage Write API, larger ones use a load job
+STREAM_MAX_ROWS = 5000
+# Stay below the 10 MB limit of a single AppendRows request
+_APPEND_MAX_BYTES = 8 * 1024 * 1024
+_REQUEST_ARROW_SCHEMA = pa.schema([("request", pa.string()), ("index_no", pa.int64())])
+
+def stream_rows_to_table(table_name, rows, write_client=None):
+  """Appends (request, index_no) rows to a BigQuery table with the Storage Write API.
+
+  The rows are sent as Arrow record batches to the table's default stream, whose
+  writes are committed immediately.
+
+  Args:
+    table_name: The full table name in the form "project.dataset.table".
+    rows: A list of (request JSON string, index_no) tuples.
+    write_client: An optional BigQueryWriteClient, a new one is created (and closed) if omitted.
+
+  Raises:
+    RuntimeError: If BigQuery rejects any of the appended rows.
+  """
+  # A client created here is closed at the end, a client passed in is left open
+  owns_client = write_client is None
+  if owns_client:
+    write_client = bigquery_storage_v1.BigQueryWriteClient()
+  try:
+    project, dataset, table = table_name.split(".")
+    stream_name = f"{write_client.table_path(project, dataset, table)}/streams/_default"
+
+    arrow_table = pa.Table.from_pylist([{"request": r, "index_no": int(i)} for r, i in rows],
+                                       schema=_REQUEST_ARROW_SCHEMA)
+    # Split into record batches that fit into a single append request
+    row_bytes = max(1, arrow_table.nbytes // max(1, arrow_table.num_rows))
+    batches = arrow_table.to_batches(max_chunksize=max(1, _APPEND_MAX_BYTES // row_bytes))
+    writer_schema = bqs_types.ArrowSchema(serialized_schema=_REQUEST_ARROW_SCHEMA.serialize().to_pybytes())
+    requests_iter = (
+        bqs_types.AppendRowsRequest(
+            write_stream=stream_name,
+            arrow_rows=bqs_types.AppendRowsRequest.ArrowData(
+                writer_schema=writer_schema,
+                rows=bqs_types.ArrowRecordBatch(serialized_record_batch=batch.serialize().to_pybytes())))
+        for batch in batches)
+
+    responses = write_client.append_rows(
+        requests_iter, metadata=(("x-goog-request-params", f"write_stream={stream_name}"),))
+    for response in responses:
+      if response.error.code or response.row_errors:
+        raise RuntimeError(f"Streaming rows to {table_name} failed: {response.error.message} {list(response.row_errors)}")
+  finally:
+    if owns_client:
+      write_client.transport.close()
+
 def build_run_batch(bq_client, batch_index, labels_ref, PROJECT_ID, DATASET_ID, run_name, model, stat_prompt, examples, temperature, top_p):
   """Builds necessary the batch request job, run the batch process job and returns the results.
 
@@ -294,10 +597,10 @@ def build_run_batch(bq_client, batch_index, labels_ref, PROJECT_ID, DATASET_ID,
     3. Creates the input table in BigQuery if it doesn't exist.
     4. For index item in the batch_index:
        - Constructs a dynamic prompt using the provided examples and the current index.
-       - Creates a batch data dataframe using the static prompt, dynamic prompt, and specified parameters.
-       - Uploads the dataframe to a GCS bucket
-       - Creates a Big query table using the data stored in GCS bucket. 
-    6. Generates a request.json file for batch processing.
+       - Creates a batch request using the static prompt, dynamic prompt, and specified parameters.
+    5. Streams the requests into the input table with the Storage Write API, or for large
+       batches and existing tables uploads them with a load job.
+    6. Builds the request for batch processing.
     7. Sends the batch prediction job to the specified project.
     8. Waits until the batch prediction job concludes.
     9. Generate a Big Query table that processes the BatchPredictionJob
@@ -329,35 +632,55 @@ def build_run_batch(bq_client, batch_index, labels_ref, PROJECT_ID, DATASET_ID,
       bigquery.SchemaField('index_no', 'INTEGER')
   ]
   
-  # Create the table if it doesnt exist
+  # Create the table if it doesnt exist, remembering whether it is new
   table = bigquery.Table(input_table_name, schema=schema)
-  if_tbl_exists(bq_client, table)
+  try:
+    bq_client.get_table(table)
+    new_table = False
+  except NotFound:
+    bq_client.create_table(table)
+    new_table = True
   
-  # Create the pandas df that stores the requests
-  batch_df = pd.DataFrame(columns=["request", "index_no"])
-
+  # Collect the requests as rows and build the pandas df that stores them once
+  # The few-shot examples are shared by every request, convert them once
+  examples_parts = prompt_parts(examples)
+  rows = []
   for t in batch_index:
-    dyna_prompt = examples + create_ex(t, False)
-    df_temp = pd.DataFrame([[batch_data_create(stat_prompt, dyna_prompt, temperature, top_p), t]], columns=["request", "index_no"])
-    batch_df = pd.concat([batch_df, df_temp], ignore_index=True)
-  
-  job_config = bigquery.LoadJobConfig(schema=schema, write_disposition="WRITE_TRUNCATE")
-  job_config.source_format = 'CSV'
+    rows.append((batch_data_create(stat_prompt, create_ex(t, False), temperature, top_p, examples_parts), t))
 
-  job = bq_client.load_table_from_dataframe(
-      batch_df, input_table_name, job_config=job_config
-  )  # Make an API request.
-  job.result()  # Wait for the job to complete.
+  streamed = False
+  if new_table and len(rows) <= STREAM_MAX_ROWS:
+    # Stream the rows into the fresh table, no load job to spin up
+    try:
+      stream_rows_to_table(input_table_name, rows)
+      streamed = True
+    except (RuntimeError, GoogleAPIError) as e:
+      # Appends commit immediately, the truncating load job below overwrites any partial rows
+      warnings.warn(f"Streaming to {input_table_name} failed, falling back to a load job: {e}")
+
+  if not streamed:
+    # Large batches, existing tables (which must be truncated) and failed streams go through a load job
+    batch_df = pd.DataFrame(rows, columns=["request", "index_no"])
+    batch_df["index_no"] = batch_df["index_no"].astype("int64")
+
+    job_config = bigquery.LoadJobConfig(schema=schema, write_disposition="WRITE_TRUNCATE")
+    # Ship typed columns as Parquet, the JSON requests travel as STRING columns loaded into the JSON field
+    job_config.source_format = bigquery.SourceFormat.PARQUET
+
+    job = bq_client.load_table_from_dataframe(
+        batch_df, input_table_name, job_config=job_config
+    )  # Make an API request.
+    job.result()  # Wait for the job to complete.
  
-  # Generate the request.json for batch processing
-  write_request("spacehackbatch_check", model, "bq://" + input_table_name,
-                "bq://" + output_table_name)
+  # Build the request for batch processing
+  payload = build_request("spacehackbatch_check", model, "bq://" + input_table_name,
+                          "bq://" + output_table_name)
 
   # Send the batch response
-  response = create_batch_prediction_job(PROJECT_ID, "request.json")
+  response = create_batch_prediction_job(PROJECT_ID, payload)
   # Run the batch process job and wait for completion.
   job = aiplatform.BatchPredictionJob(response["name"].split("/")[-1])
-  job.wait_for_completion()
+  wait_for_job(job)
 
   # The query to generate a final table with results
   create_table_query = f"""
@@ -373,21 +696,23 @@ def build_run_batch(bq_client, batch_index, labels_ref, PROJECT_ID, DATASET_ID,
   # Run the query
   query_job = bq_client.query(create_table_query)
   results = query_job.result()
-  # Clean up after the run
-  # Delete the interim tables
-  bq_client.delete_table(output_table_name, not_found_ok=True)  # Make an API request.
-  bq_client.delete_table(input_table_name, not_found_ok=True)  # Make an API request.
-  # Delete the reqest.json file
-  try:
-    os.remove("request.json")
-  except FileNotFoundError:
-      pass
-  # Download the results to generate KPIs
-  download_query = f"""
-  SELECT index_no, actual, predicted, explanation, interest_score
-  FROM {PROJECT_ID}.{DATASET_ID}.{run_name} 
-  """
-  return bq_client.query_and_wait(download_query).to_dataframe()
+  # Clean up after the run while the results are downloaded, the cleanup does not touch the final table
+  with ThreadPoolExecutor(max_workers=2) as ex:
+    cleanup = [
+      # Delete the interim tables
+      ex.submit(bq_client.delete_table, output_table_name, not_found_ok=True),  # Make an API request.
+      ex.submit(bq_client.delete_table, input_table_name, not_found_ok=True),  # Make an API request.
+    ]
+    # Download the results to generate KPIs
+    download_query = f"""
+    SELECT index_no, actual, predicted, explanation, interest_score
+    FROM {PROJECT_ID}.{DATASET_ID}.{run_name} 
+    """
+    results_df = bq_client.query_and_wait(download_query).to_dataframe()
+    # Surface any cleanup error
+    for future in cleanup:
+      future.result()
+  return results_df
 
 def display_images(index_no):
   """
@@ -400,9 +725,10 @@ def display_images(index_no):
   reference_image_path = f"data/pics/Example_{index_no}_fig_{1}.png"
   difference_image_path = f"data/pics/Example_{index_no}_fig_{2}.png"
 
-  real_image = plt.imread(real_image_path)
-  reference_image = plt.imread(reference_image_path)
-  difference_image = plt.imread(difference_image_path)
+  # Read the three files concurrently, png decompression releases the GIL
+  with ThreadPoolExecutor(max_workers=3) as ex:
+    real_image, reference_image, difference_image = list(
+        ex.map(plt.imread, [real_image_path, reference_image_path, difference_image_path]))
 
   fig, axes = plt.subplots(1, 3, figsize=(10, 5))
 
@@ -439,3 +765,22 @@ def add_red_circle(image):
   plt.close(fig)
   
   return img_array
+
+def add_red_circle_fast(image):
+  """Adds a red circle to the center of an image by stamping a precomputed ring mask.
+
+  Unlike add_red_circle no matplotlib figure is rendered, the grayscale image is
+  copied into an RGB array and the ring pixels are set to red directly.
+
+  Args:
+    image: A 2D array with values in the 0-255 range, ideally already uint8.
+
+  Returns:
+    A (H, W, 3) uint8 array with the red circle drawn at the center.
+  """
+  img8 = np.asarray(image, dtype=np.uint8)
+  rgb = np.repeat(img8[:, :, None], 3, axis=2)
+  cx, cy = image.shape[1] // 2, image.shape[0] // 2
+  r = _RING_RADIUS
+  rgb[cy - r:cy + r + 1, cx - r:cx + r + 1][RING] = [255, 0, 0]
+  return rgb